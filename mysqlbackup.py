@@ -4,12 +4,23 @@
 # Created on:       2024-12-26
 import configargparse
 import getpass
+import hashlib
+import json
+import os
+import shlex
+import shutil
+import socket
+import subprocess
 import sys
+import tempfile
 import platform
+import re
 import time
-import delegator
 import psutil
+import pymysql
+import yaml
 from datetime import datetime
+from collections import OrderedDict
 from loguru import logger
 from threading import Thread
 from pathlib import Path
@@ -18,24 +29,133 @@ py_file_path = Path(sys.argv[0])
 py_file_pre = py_file_path.parts[-1].replace('.py', '')
 log_file = py_file_path.parent / 'logs' / f'{py_file_pre}.log'
 log_file.parent.mkdir(exist_ok=True, parents=True)
-logger.add(log_file, rotation='100MB', colorize=True, retention=10, compression='zip')
+
+IS_WINDOWS = platform.system() == "Windows"
+CPU_COUNT = psutil.cpu_count() or 1
+
+TOOL_ALIAS = {
+    'dump': 'mysqldump', 'mysqldump': 'mysqldump',
+    'pump': 'mysqlpump', 'mysqlpump': 'mysqlpump',
+    'xbk': 'xtrabackup', 'xtrabackup': 'xtrabackup',
+    'dumper': 'mydumper', 'mydumper': 'mydumper'
+}
+WS_RE = re.compile(r'\s+')
+
+# seconds between two hang checks, xtrabackup is not checked because it takes the backup lock at the end
+# of backup, long after the check window. mydumper --trx-consistency-only just holds FTWRL for a moment
+HANG_CHECK_INTERVAL = {'mysqldump': 1, 'mysqlpump': 1, 'mydumper': 10}
+
+JUST_INSERT_ARGS = ('--skip-add-drop-table', '--skip-add-locks', '--no-create-info')
+NO_DATA_ARGS = {
+    'mysqldump': (
+        '--no-data', '--skip-lock-tables', '--skip-add-drop-database', '--skip-add-drop-table',
+        '--skip-add-drop-trigger'
+    ),
+    'mysqlpump': ('--skip-dump-rows',),
+    'mydumper': ('--no-data', '--no-locks'),
+}
+
+# backup command options for each tool, the whitespace is normalized once when the module is imported
+BACKUP_COMMAND_TMPL = {
+    'mysqldump': WS_RE.sub(' ', '''
+        --master-data=2 --single-transaction --set-gtid-purged=AUTO --skip-tz-utc --complete-insert
+        --hex-blob --default-character-set utf8mb4 --routines --events --triggers --add-drop-table
+        --max-allowed-packet=256M --log-error={log} {filter} | lz4 -z -9 -c
+        > {file}
+    ''').strip(),
+    'mysqlpump': WS_RE.sub(' ', '''
+        --default-parallelism={threads} --single-transaction --set-gtid-purged=ON --skip-tz-utc
+        --add-drop-table --complete-insert --extended-insert=1000 --hex-blob --default-character-set utf8mb4
+        --routines --events --triggers --log-error-file={log} {filter} | lz4 -z -9 -c
+        > {file}
+    ''').strip(),
+    'mydumper': WS_RE.sub(' ', '''
+        --threads {threads} --trx-consistency-only --use-savepoints --triggers --events --routines
+        --skip-definer --compress --rows 100000 --skip-tz-utc --complete-insert --set-names utf8mb4
+        --disk-limits 1024:4096 --logfile {log} -v 3 --stream -o {tmp_dir}
+        > {file}
+    ''').strip(),
+    'xtrabackup': WS_RE.sub(' ', '''
+        --backup --stream=xbstream --compress --compress-threads={threads} --parallel={threads}
+        --target-dir={target_dir} --tmpdir={tmp_dir} --extra-lsndir={history_dir}
+        2>>{log} 1>{file}
+    ''').strip(),
+}
+
+try:
+    from yaml import CSafeLoader as SafeLoader, CDumper as Dumper
+except ImportError:
+    from yaml import SafeLoader, Dumper
+
+
+class YAMLConfigFileParser(configargparse.YAMLConfigFileParser):
+    """YAML config parser pinned to the libyaml C loader when it is available"""
+
+    def _load_yaml(self):
+        return yaml, SafeLoader, Dumper
+
+
+class CachedYAMLConfigFileParser(YAMLConfigFileParser):
+    """Reuse a json copy of the parsed YAML config while the config file is not modified"""
+
+    cache_dir = Path.home() / '.cache' / 'mysqlbackup'
+
+    def parse(self, stream):
+        config_file = getattr(stream, 'name', None)
+        if not config_file:
+            return super().parse(stream)
+
+        config_file = Path(config_file).absolute()
+        try:
+            mtime = os.stat(config_file).st_mtime_ns
+        except OSError:
+            return super().parse(stream)
+
+        cache_file = self.cache_dir / f'{hashlib.sha1(str(config_file).encode()).hexdigest()}.json'
+        try:
+            with open(cache_file, encoding='utf8') as f:
+                cache = json.loads(f.read())
+            if cache.get('mtime') == mtime:
+                return OrderedDict(cache['config'])
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+        result = super().parse(stream)
+        try:
+            # list items keep their yaml types (such as date), argparse converts them to str anyway
+            config = json.dumps(
+                {'path': str(config_file), 'mtime': mtime, 'config': list(result.items())}, default=str
+            )
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            # write into a temp file (mode 0600) first, then rename it, so readers never see a partial cache
+            fd, tmp_file = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf8') as f:
+                    f.write(config)
+                os.replace(tmp_file, cache_file)
+            except BaseException:
+                os.unlink(tmp_file)
+                raise
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f'Could not write config cache {cache_file}: {e}')
+        return result
 
 
 def parse_mysql_args():
     """Parse args to connect to MySQL"""
 
-    if platform.system() == "Windows":
+    if IS_WINDOWS:
         config_file_parser_class = configargparse.DefaultConfigFileParser
         default_config_files = ['config.ini', 'conf.d/*.ini']
     else:
-        config_file_parser_class = configargparse.YAMLConfigFileParser
+        config_file_parser_class = CachedYAMLConfigFileParser
         default_config_files = [
             'config.yaml', 'conf.d/*.yaml',
             'config.yml', 'conf.d/*.yml'
         ]  # 可以设置更多路径
 
     port = 3306
-    half_cpus = psutil.cpu_count() // 2
+    half_cpus = CPU_COUNT // 2
     threads = half_cpus if half_cpus > 4 else 3
 
     parser = configargparse.ArgumentParser(
@@ -81,12 +201,7 @@ def parse_mysql_args():
 
     backup = parser.add_argument_group('backup setting')
     backup.add_argument('--tool', dest='tool', type=str,
-                        choices=[
-                            'dump', 'mysqldump',
-                            'pump', 'mysqlpump',
-                            'xbk', 'xtrabackup',
-                            'dumper', 'mydumper'
-                        ],
+                        choices=list(TOOL_ALIAS),
                         help="Choice a backup tool.")
     backup.add_argument('--base-dir', dest='base_dir', type=str,
                         help="Base dir for get backup command if set.")
@@ -142,17 +257,10 @@ def parse_mysql_args_from_command_line(args, parser=None):
     elif not args.login_path:
         args.password = args.password[0]
 
-    if args.tool in ['xbk', 'xtrabackup']:
-        args.tool = 'xtrabackup'
-    elif args.tool in ['dump', 'mysqldump']:
-        args.tool = 'mysqldump'
-    elif args.tool in ['pump', 'mysqlpump']:
-        args.tool = 'mysqlpump'
-    else:
-        args.tool = 'mydumper'
-        if args.login_path:
-            logger.error('mydumper does not support for args --login-path')
-            sys.exit(1)
+    args.tool = TOOL_ALIAS[args.tool]
+    if args.tool == 'mydumper' and args.login_path:
+        logger.error('mydumper does not support for args --login-path')
+        sys.exit(1)
 
     if args.tool == 'mydumper' and args.tables:
         logger.warning(f'--tables must set the db_name in front of tb_name. '
@@ -165,133 +273,181 @@ def parse_mysql_args_from_command_line(args, parser=None):
             logger.error(f'Base dir [{args.base_dir.name}] does not exists.')
             sys.exit(1)
 
+    args.tool_name = args.tool
     args.tool = Path(args.tool) if not args.base_dir else args.base_dir / args.tool
 
     args.backup_dir = Path(args.backup_dir)
     args.backup_dir.mkdir(parents=True, exist_ok=True)
+    backup_dir_abs = args.backup_dir.absolute()
+    args.tmp_dir = backup_dir_abs / 'tmp'
+    args.history_dir = backup_dir_abs / 'history'
 
     args.backup_log = py_file_path.parent / 'logs' / args.backup_log
 
     if not args.backup_file:
-        get_ip_command = '''
-            ip address show $(ip r | awk '/default/{print $5}') | grep inet | 
-            grep -v inet6 | awk -F "[ |/]+" '{print $3}'
-        '''.replace('\n', '')
-        resp = delegator.run(get_ip_command)
-        host = resp.out.replace('\n', '') if resp.return_code == 0 else args.host
+        host = get_host_ip(default=args.host)
 
         datetime_format = '%Y%m%d_%H%M%S'
         datetime_str = datetime.now().strftime(datetime_format)
 
-        if args.tool.name == 'xtrabackup':
+        if args.tool_name == 'xtrabackup':
             backup_file_suffix = 'fullback.xb'
             if args.incremental:
-                if (args.backup_dir.absolute() / 'history' / 'xtrabackup_checkpoints').exists():
+                if (args.history_dir / 'xtrabackup_checkpoints').exists():
                     backup_file_suffix = 'incremental.xb'
                 else:
                     logger.warning(f'last fullback does not exists, ignore args: --incremental')
-        elif args.tool.name == 'mydumper':
+        elif args.tool_name == 'mydumper':
             backup_file_suffix = 'stream'
         else:
             backup_file_suffix = 'sql.lz4'
-        args.backup_file = args.backup_dir / (f'{host.replace(".", "_")}_{args.port}_{args.tool.name}_'
+        args.backup_file = args.backup_dir / (f'{host.replace(".", "_")}_{args.port}_{args.tool_name}_'
                                               f'{datetime_str}.{backup_file_suffix}')
     else:
         args.backup_file = Path(args.backup_file)
 
     if args.extra is None:
         args.extra = []
+
+    args.connect_args = get_connect_args(args)
     return args
 
 
+def get_host_ip(default):
+    """Get the local ip of the default route, connect a udp socket does not send any packet"""
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(('8.8.8.8', 80))
+            return s.getsockname()[0]
+    except OSError:
+        return default
+
+
 def add_extra_args(args):
-    args.extra = "".join(args.extra)
+    # every --extra value may hold several options, such as: --extra "--opt1 --opt2"
+    args.extra = [arg for extra in args.extra for arg in shlex.split(extra)]
 
-    if args.tool.name in ['mysqldump', 'mysqlpump', 'mydumper']:
-        if args.just_insert and args.tool.name in ['mysqldump', 'mysqlpump']:
-            args.extra += f' --skip-add-drop-table --skip-add-locks --no-create-info'
+    if args.tool_name in ['mysqldump', 'mysqlpump', 'mydumper']:
+        if args.just_insert and args.tool_name in ['mysqldump', 'mysqlpump']:
+            args.extra.extend(JUST_INSERT_ARGS)
         if args.no_data:
-            if args.tool.name == 'mysqldump':
-                args.extra += (f' --no-data --skip-lock-tables --skip-add-drop-database --skip-add-drop-table '
-                               f'--skip-add-drop-trigger')
-            elif args.tool.name == 'mysqlpump':
-                args.extra += f' --skip-dump-rows'
-            else:
-                args.extra += f' --no-data --no-locks'
+            args.extra.extend(NO_DATA_ARGS[args.tool_name])
     return
 
 
 def get_connect_args(args):
-    connect_args = ''
+    connect_args = []
     if args.config:
-        connect_args += f' --defaults-file={args.config}'
+        connect_args.append(f'--defaults-file={args.config}')
     if args.socket:
-        connect_args += f' --socket={args.socket}'
+        connect_args.append(f'--socket={args.socket}')
 
     if args.login_path:
-        config_login_path(args)
-        connect_args += f' --login-path={args.login_path}'
+        connect_args.append(f'--login-path={args.login_path}')
     else:
-        connect_args += f' --host={args.host} --port={args.port} --user={args.user}'
+        connect_args.extend([f'--host={args.host}', f'--port={args.port}', f'--user={args.user}'])
     return connect_args
 
 
-def check_hung(args):
-    connect_args = get_connect_args(args)
+def get_mysql_env(args):
+    return {**os.environ, 'MYSQL_PWD': args.password or ''}
+
+
+def check_hung(args, interval=1):
+    if args.login_path or args.config or (args.host == 'localhost' and not args.socket):
+        # check hang by mysql client, so that it connects to the same server as the backup tool:
+        # pymysql does not support login path, it prefers the socket of the defaults file over host/port
+        # (and fails on repeated keys in my.cnf), and it connects to localhost over tcp, while mysql client
+        # uses the default unix socket (matters for skip-networking and auth_socket accounts)
+        check_hung_by_client(args, interval)
+    else:
+        check_hung_by_connection(args, interval)
+    return
+
+
+def check_hung_by_connection(args, interval=1):
+    try:
+        # like mysql client, the socket is only used for localhost, other hosts are connected over tcp
+        conn = pymysql.connect(
+            host=args.host, port=args.port, user=args.user, password=args.password or '',
+            unix_socket=args.socket if args.host == 'localhost' else None, autocommit=True
+        )
+    except pymysql.MySQLError as e:
+        logger.error(f'Failed to check hang: {e}')
+        sys.exit(1)
+
     # PS: do not need to add condition: state='Waiting for table metadata lock',
     # because that thread does not belong backup process
-    c_command = f'''
-            mysql {connect_args} {args.extra} 
-            --skip-column-names -e "select id from information_schema.processlist 
-            where info='FLUSH TABLES WITH READ LOCK' and user='{args.user}';"
-        '''.replace('\n', ' ')
-    kill_command = '''
-        mysql {connect_args} {extra} --skip-column-names -e "kill {thread_id};" 
-    '''.replace('\n', ' ')
-    i = 1
-    if args.debug:
-        logger.debug(c_command)
-    while i < 180:
-        if args.debug:
-            logger.debug(f'Check hang {i} times.')
-            logger.debug(c_command)
-        resp = delegator.run(c_command, env={'MYSQL_PWD': args.password})
-        if resp.return_code == 0 and i > 3:
-            thread_ids = str(resp.out).split('\n')
-            thread_ids.remove('')
+    sql = 'select id from information_schema.processlist where info=%s and user=%s'
+    with conn, conn.cursor() as cursor:
+        # FTWRL is normal in the first seconds of backup, so wait before checking
+        time.sleep(3)
+        for i in range(3, 180, interval):
+            if args.debug:
+                logger.debug(f'Check hang after {i} seconds.')
+            try:
+                cursor.execute(sql, ('FLUSH TABLES WITH READ LOCK', args.user))
+                thread_ids = [row[0] for row in cursor.fetchall()]
+            except pymysql.MySQLError as e:
+                logger.error(f'Failed to check hang: {e}')
+                sys.exit(1)
+
             if thread_ids:
-                logger.info(f'Found hang thread: [{"|".join(thread_ids)}], '
+                logger.info(f'Found hang thread: [{"|".join(map(str, thread_ids))}], '
                             f'now killing it.')
 
             for t_id in thread_ids:
-                kill_command_fill = kill_command.format(
-                    connect_args=connect_args,
-                    extra=args.extra,
-                    thread_id=t_id
-                )
-                if args.debug:
-                    logger.debug(kill_command_fill)
-                resp = delegator.run(kill_command_fill, env={'MYSQL_PWD': args.password})
-                if resp.return_code == 0:
+                try:
+                    cursor.execute('kill %s', (t_id,))
                     logger.info(f'Successfully kill thread: {t_id}')
-                else:
-                    logger.error(f'Failed to kill thread: {t_id}')
-        elif resp.return_code != 0:
-            logger.error(f'Failed to check hang: {resp.err}')
+                except pymysql.MySQLError as e:
+                    logger.error(f'Failed to kill thread: {t_id}, {e}')
+            time.sleep(interval)
+    return
+
+
+def check_hung_by_client(args, interval=1):
+    # PS: do not need to add condition: state='Waiting for table metadata lock',
+    # because that thread does not belong backup process
+    mysql_argv = ['mysql', *args.connect_args, *args.extra, '--skip-column-names', '-e']
+    c_argv = [
+        *mysql_argv,
+        f"select id from information_schema.processlist "
+        f"where info='FLUSH TABLES WITH READ LOCK' and user='{args.user}';"
+    ]
+    env = get_mysql_env(args)
+    if args.debug:
+        logger.debug(shlex.join(c_argv))
+    # FTWRL is normal in the first seconds of backup, so wait before checking
+    time.sleep(3)
+    for i in range(3, 180, interval):
+        if args.debug:
+            logger.debug(f'Check hang after {i} seconds.')
+        resp = subprocess.run(c_argv, env=env, capture_output=True, text=True)
+        if resp.returncode != 0:
+            logger.error(f'Failed to check hang: {resp.stderr}')
             sys.exit(1)
-        i += 1
-        time.sleep(1)
+
+        thread_ids = resp.stdout.split()
+        if thread_ids:
+            logger.info(f'Found hang thread: [{"|".join(thread_ids)}], '
+                        f'now killing it.')
+
+        for t_id in thread_ids:
+            kill_argv = [*mysql_argv, f'kill {t_id};']
+            if args.debug:
+                logger.debug(shlex.join(kill_argv))
+            resp = subprocess.run(kill_argv, env=env, capture_output=True, text=True)
+            if resp.returncode == 0:
+                logger.info(f'Successfully kill thread: {t_id}')
+            else:
+                logger.error(f'Failed to kill thread: {t_id}')
+        time.sleep(interval)
     return
 
 
 def check_command(command):
-    if platform.system() == "Windows":
-        c_command = f'where {command}'
-    else:
-        c_command = f'which {command}'
-
-    resp = delegator.run(c_command)
-    if resp.return_code != 0:
+    if shutil.which(str(command)) is None:
         logger.error(f'Could not find command: {command}')
         sys.exit(1)
     return
@@ -303,93 +459,84 @@ def pre_backup(args):
     check_command('lz4')
 
     # check backup process if exists
-    connect_args = get_connect_args(args)
-    program = command = f'{args.tool} {connect_args} {args.extra}'
-    if platform.system() == "Windows":
-        command = f"tasklist -v | findstr %{program}%"
-    else:
-        command = f"ps -ef | grep -v grep | grep -E '{program}"
-
-    if args.debug:
-        logger.debug(command)
-
-    resp = delegator.run(command)
-    if resp.return_code == 0:
-        logger.error(f'Another backup process is running: {resp.out}')
-        sys.exit(1)
+    connect_args = set(args.connect_args)
+    for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
+        # name is None if access denied, and it ends with .exe on windows
+        if proc.info['pid'] == os.getpid() or Path(proc.info['name'] or '').stem != args.tool_name:
+            continue
+        cmdline = proc.info['cmdline'] or []
+        if connect_args.issubset(cmdline):
+            logger.error(f'Another backup process is running: [{proc.info["pid"]}] {" ".join(cmdline)}')
+            sys.exit(1)
 
     # check connect
-    connect_args = get_connect_args(args)
-    command = f"""
-        mysql {connect_args} {args.extra} --skip-column-names 
-        -e "select count(concat(table_schema, '.', table_name)) from information_schema.tables 
-        where table_schema not in ('sys','information_schema','performance_schema');"
-    """.replace('\n', ' ')
-    map(lambda x: command.replace(x, ' '), ('\n', '  ', '\t'))
+    argv = [
+        'mysql', *args.connect_args, *args.extra, '--skip-column-names', '-e',
+        "select count(concat(table_schema, '.', table_name)) from information_schema.tables "
+        "where table_schema not in ('sys','information_schema','performance_schema');"
+    ]
     if args.debug:
-        logger.debug(command)
-    resp = delegator.run(command, env={'MYSQL_PWD': args.password})
-    if resp.return_code != 0:
+        logger.debug(shlex.join(argv))
+    resp = subprocess.run(argv, env=get_mysql_env(args), capture_output=True, text=True)
+    if resp.returncode != 0:
         logger.error(f'Could not connect to mysql server: {args.host}:{args.port}. '
-                     f'Got error: {resp.err}')
+                     f'Got error: {resp.stderr}')
         sys.exit(1)
     return
 
 
 def add_filter_args(args):
-    filter_args = ''
+    filter_args = []
     if args.databases:
-        if args.tool.name == 'mysqldump':
-            filter_args += f' --databases {" ".join(args.databases)}'
-        elif args.tool.name == 'mysqlpump':
-            filter_args += f' --include-databases {" ".join(args.databases)}'
-        elif args.tool.name == 'mydumper':
-            filter_args += " --regex '" + "\\.|".join(args.databases) + "\\.'"
+        if args.tool_name == 'mysqldump':
+            filter_args.extend(['--databases', *args.databases])
+        elif args.tool_name == 'mysqlpump':
+            filter_args.extend(['--include-databases', *args.databases])
+        elif args.tool_name == 'mydumper':
+            filter_args.extend(['--regex', "\\.|".join(args.databases) + "\\."])
         else:
             logger.error(f'We dont suggest use xtrabackup to backup specify databases or tables, '
                          f'please ues other tool for doing this. ignore these options')
             sys.exit(1)
     if args.tables:
-        if args.tool.name == 'mysqldump':
-            filter_args += f' --tables {" ".join(args.tables)}'
-        elif args.tool.name == 'mysqlpump':
-            filter_args += f' --include-tables {" ".join(args.tables)}'
-        elif args.tool.name == 'mydumper':
-            filter_args += f' --tables-list {",".join(args.tables)}'
+        if args.tool_name == 'mysqldump':
+            filter_args.extend(['--tables', *args.tables])
+        elif args.tool_name == 'mysqlpump':
+            filter_args.extend(['--include-tables', *args.tables])
+        elif args.tool_name == 'mydumper':
+            filter_args.extend(['--tables-list', ",".join(args.tables)])
         else:
             logger.error(f'We dont suggest use xtrabackup to backup specify databases or tables, '
                          f'please ues other tool for doing this. ignore these options')
             sys.exit(1)
 
     if not args.databases and not args.tables:
-        filter_args = ' --all-databases'
-    return filter_args
+        filter_args = ['--all-databases']
+    # the filter args are put into a shell command, quote every name
+    return shlex.join(filter_args)
 
 
 def config_login_path(args):
     if not args.reset:
-        c_command = f'''
-                    mysql_config_editor print -G {args.login_path} | grep password
-                '''.replace('\n', ' ')
+        c_argv = ['mysql_config_editor', 'print', '-G', args.login_path]
     else:
-        c_command = f'''
-                    mysql_config_editor remove -G {args.login_path}
-                '''.replace('\n', ' ')
+        c_argv = ['mysql_config_editor', 'remove', '-G', args.login_path]
     if args.debug:
-        logger.debug(c_command)
-    resp = delegator.run(c_command)
-    if resp.return_code != 0 or args.reset:
-        s_command = f'''
-                    mysql_config_editor set --login-path={args.login_path} --host={args.host} --password 
-                    --user={args.user} --port={args.port}
-                '''.replace('\n', ' ')
+        logger.debug(shlex.join(c_argv))
+    resp = subprocess.run(c_argv, capture_output=True, text=True)
+    if resp.returncode != 0 or 'password' not in resp.stdout or args.reset:
+        s_argv = [
+            'mysql_config_editor', 'set', f'--login-path={args.login_path}', f'--host={args.host}', '--password',
+            f'--user={args.user}', f'--port={args.port}'
+        ]
         if args.socket:
-            s_command += f' --socket={args.socket}'
+            s_argv.append(f'--socket={args.socket}')
         if args.debug:
-            logger.debug(s_command)
+            logger.debug(shlex.join(s_argv))
         set_msg = 'unset' if not args.reset else 'reset'
         logger.info(f'Login path {set_msg}, please enter the password for backup.')
-        delegator.run(s_command)
+        # keep stdin/stdout attached to the terminal, mysql_config_editor prompts for the password
+        subprocess.run(s_argv)
     return
 
 
@@ -408,70 +555,50 @@ def process_backup(args):
     logger.info(f'Log into logfile: {args.backup_log}')
     logger.info(f'Result save into: {args.backup_file}')
 
-    connect_args = get_connect_args(args)
-    command = f'{args.tool} {connect_args} {args.extra}'
-
-    tmp_dir = args.backup_dir.absolute() / 'tmp'
-    if args.tool.name in ['mydumper', 'xtrabackup']:
-        tmp_dir.mkdir(parents=True, exist_ok=True)
+    if args.tool_name in ['mydumper', 'xtrabackup']:
+        args.tmp_dir.mkdir(parents=True, exist_ok=True)
 
     filter_args = add_filter_args(args)
-    if args.tool.name == 'mysqldump':
-        command += f''' 
-            --master-data=2 --single-transaction --set-gtid-purged=AUTO --skip-tz-utc --complete-insert 
-            --hex-blob --default-character-set utf8mb4 --routines --events --triggers --add-drop-table 
-            --max-allowed-packet=256M --log-error={args.backup_log} {filter_args} | lz4 -z -9 -c 
-            > {args.backup_file}
-        '''.replace('\n', ' ')
-    elif args.tool.name == 'mysqlpump':
-        command += f'''
-            --default-parallelism={args.threads} --single-transaction --set-gtid-purged=ON --skip-tz-utc 
-            --add-drop-table --complete-insert --extended-insert=1000 --hex-blob --default-character-set utf8mb4
-            --routines --events --triggers --log-error-file={args.backup_log} {filter_args} | lz4 -z -9 -c
-            > {args.backup_file}
-        '''.replace('\n', ' ')
-    elif args.tool.name == 'mydumper':
-        command += f'''
-            --threads {args.threads} --trx-consistency-only --use-savepoints --triggers --events --routines 
-            --skip-definer --compress --rows 100000 --skip-tz-utc --complete-insert --set-names utf8mb4 
-            --disk-limits 1024:4096 --logfile {args.backup_log} -v 3 --stream -o {tmp_dir}
-            > {args.backup_file}
-        '''.replace('\n', ' ')
-    else:
-
-        history_dir = args.backup_dir.absolute() / 'history'
-        history_dir.mkdir(parents=True, exist_ok=True)
-
-        if args.incremental and (history_dir / 'xtrabackup_checkpoints').exists():
-            get_lsn_command = f"""
-                grep to_lsn {history_dir / 'xtrabackup_checkpoints'} | sed -r 's@to_lsn = @@g'
-            """
+    extra_args = list(args.extra)
+    if args.tool_name == 'xtrabackup':
+        args.history_dir.mkdir(parents=True, exist_ok=True)
+
+        if args.incremental and (args.history_dir / 'xtrabackup_checkpoints').exists():
+            get_lsn_command = WS_RE.sub(' ', f"""
+                grep to_lsn {args.history_dir / 'xtrabackup_checkpoints'} | sed -r 's@to_lsn = @@g'
+            """).strip()
             if args.debug:
                 logger.debug(get_lsn_command)
-            resp = delegator.run(get_lsn_command)
-            args.extra += f''' --incremental-lsn={resp.out}'''
-
-        if not args.login_path:
-            command += ' --password=$MYSQL_PWD'
-        command += f'''
-            --backup --stream=xbstream --compress --compress-threads={args.threads} --parallel={args.threads}
-            --target-dir={args.backup_dir} --tmpdir={tmp_dir} --extra-lsndir={history_dir} 
-            2>>{args.backup_log} 1>{args.backup_file}
-        '''.replace('\n', ' ')
-
+            resp = subprocess.run(get_lsn_command, shell=True, capture_output=True, text=True)
+            extra_args.append(f'--incremental-lsn={resp.stdout.strip()}')
+
+    # the backup runs in a shell, quote every arg so that the user's quoting of --extra is kept
+    shell_args = [shlex.join([str(args.tool), *args.connect_args, *extra_args])]
+    if args.tool_name == 'xtrabackup' and not args.login_path:
+        # leave it unquoted, so that the shell expands the password
+        shell_args.append('--password=$MYSQL_PWD')
+
+    command = ' '.join([
+        *shell_args,
+        BACKUP_COMMAND_TMPL[args.tool_name].format(
+            log=args.backup_log, filter=filter_args, file=args.backup_file, threads=args.threads,
+            target_dir=args.backup_dir, tmp_dir=args.tmp_dir, history_dir=args.history_dir
+        )
+    ])
     if args.debug:
         logger.debug(command)
 
     try:
-        resp = delegator.run(command, env={'MYSQL_PWD': args.password})
+        # the backup command is a shell pipeline (compress and redirect into backup file)
+        resp = subprocess.run(command, shell=True, env=get_mysql_env(args), capture_output=True, text=True)
 
-        if resp.return_code == 0 and args.tool.name in ['mydumper', 'xtrabackup']:
-            tmp_dir.rmdir()
+        if resp.returncode == 0 and args.tool_name in ['mydumper', 'xtrabackup']:
+            args.tmp_dir.rmdir()
 
-        if resp.return_code != 0:
+        if resp.returncode != 0:
             logger.error(f'Could not process backup for mysql server: {args.host}:{args.port}.')
-            if resp.err:
-                logger.error(f'Got error: {resp.err}')
+            if resp.stderr:
+                logger.error(f'Got error: {resp.stderr}')
             else:
                 logger.error(f'Please check logfile {args.backup_log} for get more error detail.')
 
@@ -484,12 +611,22 @@ def process_backup(args):
     return
 
 
+def init_logging():
+    """Add the rotating log file sink, only called when a backup really runs"""
+    logger.add(log_file, rotation='100MB', colorize=True, retention=10, compression='zip')
+    return
+
+
 def main(args):
+    init_logging()
+    if args.login_path:
+        config_login_path(args)
     add_extra_args(args)
     pre_backup(args)
     # check hang
-    t = Thread(target=check_hung, args=(args,), daemon=True)
-    t.start()
+    if args.tool_name in HANG_CHECK_INTERVAL:
+        t = Thread(target=check_hung, args=(args, HANG_CHECK_INTERVAL[args.tool_name]), daemon=True)
+        t.start()
     # start backup
     process_backup(args)
     return